@@ -0,0 +1,217 @@
+"""
+Select features over blocks of feature columns in parallel threads.
+
+select_features() is a drop-in replacement for pycytominer.feature_select().
+The variance_threshold, drop_na_columns and correlation_threshold operations
+are computed blockwise by threads that share one read-only feature matrix;
+the correlation matrix is never held in memory as a whole. Other operations,
+and correlation_threshold on profiles with missing or infinite values or with
+tied correlation sums, are delegated to pycytominer.
+"""
+
+import concurrent.futures
+import inspect
+import os
+
+import numpy as np
+import pandas as pd
+from pycytominer import feature_select
+from pycytominer.cyto_utils import infer_cp_features, output
+
+blockwise_operations = ["variance_threshold", "drop_na_columns", "correlation_threshold"]
+
+
+def get_feature_select_defaults():
+    # Use the same cutoffs as pycytominer.feature_select()
+    return {
+        name: parameter.default
+        for name, parameter in inspect.signature(feature_select).parameters.items()
+    }
+
+
+def get_column_blocks(n_columns, block_size):
+    return [
+        np.arange(start, min(start + block_size, n_columns))
+        for start in range(0, n_columns, block_size)
+    ]
+
+
+def variance_threshold_block(feature_matrix, block, freq_cut, unique_cut):
+    n_rows = feature_matrix.shape[0]
+    excluded = []
+    for column in block:
+        values = feature_matrix[:, column]
+        values = np.sort(values[~np.isnan(values)])
+        if values.shape[0] == 0:
+            excluded.append(column)
+            continue
+
+        # Counts of each unique value, as value_counts() would return them.
+        # Neighbours are compared rather than subtracted, as inf - inf is NaN.
+        boundaries = np.flatnonzero(values[1:] != values[:-1]) + 1
+        counts = np.diff(np.concatenate([[0], boundaries, [values.shape[0]]]))
+        if counts.shape[0] < 2:
+            excluded.append(column)
+            continue
+
+        max_count, second_max_count = np.sort(counts)[::-1][:2]
+        if second_max_count / max_count < freq_cut:
+            excluded.append(column)
+        elif counts.shape[0] / n_rows < unique_cut:
+            excluded.append(column)
+
+    return excluded
+
+
+def na_columns_block(feature_matrix, block, na_cutoff):
+    na_proportion = np.isnan(feature_matrix[:, block]).sum(axis=0) / feature_matrix.shape[0]
+
+    return block[na_proportion > na_cutoff].tolist()
+
+
+def correlation_block(standardized_matrix, block, corr_threshold):
+    # Correlations of the block's features with all the features. Only the
+    # pairs below the diagonal are kept, as in get_pairwise_correlation().
+    correlations = standardized_matrix[:, block].T @ standardized_matrix
+    absolute_sums = np.abs(correlations).sum(axis=1)
+
+    correlations[np.arange(correlations.shape[1])[None, :] >= block[:, None]] = np.nan
+    pair_rows, pair_columns = np.nonzero(correlations > corr_threshold)
+
+    return absolute_sums, list(zip(block[pair_rows], pair_columns))
+
+
+def standardize_columns(feature_matrix):
+    centered = feature_matrix - feature_matrix.mean(axis=0)
+    norms = np.sqrt((centered ** 2).sum(axis=0))
+    # Constant features have no correlation, which contributes nothing to the
+    # absolute sums and never passes the threshold
+    norms[norms == 0] = np.inf
+
+    return centered / norms
+
+
+def correlation_threshold(feature_matrix, features, corr_threshold, executor, block_size):
+    standardized_matrix = standardize_columns(feature_matrix)
+    results = list(
+        executor.map(
+            lambda block: correlation_block(standardized_matrix, block, corr_threshold),
+            get_column_blocks(len(features), block_size),
+        )
+    )
+
+    # The feature with the higher absolute correlation sum of each pair is excluded
+    absolute_sums = np.concatenate([x[0] for x in results])
+    pairs = [pair for _, block_pairs in results for pair in block_pairs]
+
+    # Pairs whose sums are (nearly) tied, e.g. duplicated features, are ranked
+    # by rounding differences and pycytominer's sort order, which can't be
+    # reproduced here. None lets the caller fall back to pycytominer.
+    if pairs:
+        pair_a, pair_b = np.array(pairs).T
+        tied = np.isclose(absolute_sums[pair_a], absolute_sums[pair_b], rtol=1e-8, atol=0)
+        if tied.any():
+            return None
+
+    sorted_features = pd.Series(absolute_sums, index=features).sort_values().index
+    feature_rank = {feature: rank for rank, feature in enumerate(sorted_features)}
+
+    excluded = []
+    for pair_a, pair_b in pairs:
+        if feature_rank[features[pair_a]] > feature_rank[features[pair_b]]:
+            excluded.append(features[pair_a])
+        else:
+            excluded.append(features[pair_b])
+
+    return excluded
+
+
+def select_features(
+    profiles,
+    features="infer",
+    image_features=False,
+    samples="all",
+    operation="variance_threshold",
+    output_file="none",
+    compression_options=None,
+    float_format=None,
+    n_workers=None,
+    block_size=500,
+):
+    defaults = get_feature_select_defaults()
+
+    if isinstance(operation, str):
+        operation = [operation]
+    if features == "infer":
+        features = infer_cp_features(profiles, image_features=image_features)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    if samples != "all":
+        population_df = profiles.loc[samples, features]
+    else:
+        population_df = profiles.loc[:, features]
+    feature_matrix = population_df.to_numpy(dtype=np.float64)
+    # Missing and infinite values (e.g. from mad_robustize with a zero fudge
+    # factor) are left out of the correlations by pandas, but not by numpy
+    is_finite = np.isfinite(feature_matrix).all()
+
+    excluded_features = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for op in operation:
+            exclude = None
+            if op == "variance_threshold":
+                excluded = executor.map(
+                    lambda block: variance_threshold_block(
+                        feature_matrix,
+                        block,
+                        defaults["freq_cut"],
+                        defaults["unique_cut"],
+                    ),
+                    get_column_blocks(len(features), block_size),
+                )
+                exclude = [features[x] for block in excluded for x in block]
+            elif op == "drop_na_columns":
+                excluded = executor.map(
+                    lambda block: na_columns_block(
+                        feature_matrix, block, defaults["na_cutoff"]
+                    ),
+                    get_column_blocks(len(features), block_size),
+                )
+                exclude = [features[x] for block in excluded for x in block]
+            elif (
+                op == "correlation_threshold"
+                and is_finite
+                and defaults["corr_method"] == "pearson"
+            ):
+                exclude = correlation_threshold(
+                    feature_matrix,
+                    features,
+                    defaults["corr_threshold"],
+                    executor,
+                    block_size,
+                )
+            if exclude is None:
+                selected_df = feature_select(
+                    profiles=profiles,
+                    features=features,
+                    image_features=image_features,
+                    samples=samples,
+                    operation=[op],
+                )
+                exclude = [x for x in profiles.columns if x not in selected_df.columns]
+
+            excluded_features += exclude
+
+    excluded_features = list(set(excluded_features))
+    selected_df = profiles.drop(excluded_features, axis="columns")
+
+    if output_file != "none":
+        output(
+            df=selected_df,
+            output_filename=output_file,
+            compression_options=compression_options,
+            float_format=float_format,
+        )
+    else:
+        return selected_df
@@ -6,26 +6,24 @@ Perform the image-based profiling pipeline to process data
 
 import os
 import pathlib
+import concurrent.futures
+import functools
 from utils import (
     create_linking_columns,
     get_pipeline_options,
     concat_dataframes,
     create_gct_directories,
+    prefetch,
+    replicate_reproducibility,
+    get_backend_file,
+    validate_backend_aggregate,
 )
 import pandas as pd
 import numpy as np
-import plotly.express as px
-from pycytominer.cyto_utils.cells import SingleCells
-from pycytominer.cyto_utils import (
-    get_default_compartments,
-    write_gct,
-)
-from pycytominer import (
-    annotate,
-    normalize,
-    feature_select,
-    cyto_utils,
-)
+
+# plotly and pycytominer take seconds to import, so they are imported by the
+# steps that use them rather than here, which keeps short runs (e.g. only the
+# quality control summary) fast to start
 
 
 class RunPipeline(object):
@@ -37,21 +35,28 @@ class RunPipeline(object):
         self.pipeline_output = self.pipeline["output_dir"]
         self.output_dir = pathlib.PurePath(".", self.pipeline_output)
 
-        # Check for noncanonical compartments
         self.compartments = pipeline["compartments"]
+
+    @property
+    def noncanonical_compartments(self):
+        from pycytominer.cyto_utils import get_default_compartments
+
         canonical_compartments = get_default_compartments()
-        self.noncanonical = False
-        self.noncanonical_compartments = []
 
-        if not all(np.isin(self.compartments, canonical_compartments)):
-            self.noncanonical_compartments = list(
-                np.asarray(self.compartments)[
-                    ~np.isin(self.compartments, canonical_compartments)
-                ]
-            )
-            self.noncanonical = True
+        return list(
+            np.asarray(self.compartments)[
+                ~np.isin(self.compartments, canonical_compartments)
+            ]
+        )
+
+    @property
+    def noncanonical(self):
+        return len(self.noncanonical_compartments) > 0
 
     def pipeline_aggregate(self, batch, plate):
+        from pycytominer import cyto_utils
+        from pycytominer.cyto_utils.cells import SingleCells
+
         aggregate_steps = self.pipeline["aggregate"]
         output_dir = pathlib.PurePath(".", self.pipeline_output, batch, plate)
         aggregate_output_file = pathlib.PurePath(output_dir, f"{plate}.csv.gz")
@@ -63,7 +68,7 @@ class RunPipeline(object):
         aggregate_plate_column = aggregate_steps["plate_column"]
         aggregate_well_column = aggregate_steps["well_column"]
         strata = [aggregate_plate_column, aggregate_well_column]
-        sql_file = f'sqlite:////{os.path.abspath(os.path.join("../../backend", batch, plate, f"{plate}.sqlite"))}'
+        sql_file = f'sqlite:////{os.path.abspath(get_backend_file(batch, plate, "sqlite"))}'
 
         if "site_column" in aggregate_steps:
             aggregate_site_column = aggregate_steps["site_column"]
@@ -81,30 +86,95 @@ class RunPipeline(object):
             image_feature_categories = []
             add_image_features = False
 
-        ap = SingleCells(
-            sql_file,
-            strata=strata,
-            compartments=self.compartments,
-            compartment_linking_cols=linking_columns,
-            aggregation_operation=aggregate_steps["method"],
-            fields_of_view=aggregate_steps["fields"],
-            object_feature=object_feature,
-            add_image_features=add_image_features,
-            image_feature_categories=image_feature_categories,
-        )
+        if "source" in aggregate_steps and aggregate_steps["source"] == "auto":
+            # Reuse the aggregated profiles in the backend folder, if they match
+            # the .sqlite file, instead of aggregating again
+            backend_aggregate_file = get_backend_file(batch, plate, "csv")
+            if aggregate_steps["fields"] != "all":
+                invalid_reason = "only some fields of view are aggregated"
+            else:
+                invalid_reason = validate_backend_aggregate(
+                    backend_aggregate_file,
+                    get_backend_file(batch, plate, "sqlite"),
+                    strata=strata,
+                    compartments=self.compartments,
+                    image_feature_categories=image_feature_categories,
+                    linking_columns=linking_columns,
+                )
+
+            if invalid_reason is None:
+                print(f"Now importing backend aggregated profiles... plate: {plate}")
+                cyto_utils.output(
+                    df=pd.read_csv(backend_aggregate_file),
+                    output_filename=aggregate_output_file,
+                    compression_options=self.pipeline_options["compression"],
+                    float_format=self.pipeline_options["float_format"],
+                )
+                return
 
-        ap.aggregate_profiles(
-            output_file=aggregate_output_file,
+            print(f"Not using backend aggregated profiles ({invalid_reason})")
+
+        if "compartment_workers" in aggregate_steps:
+            compartment_workers = aggregate_steps["compartment_workers"]
+        else:
+            compartment_workers = 1
+
+        def create_single_cells():
+            return SingleCells(
+                sql_file,
+                strata=strata,
+                compartments=self.compartments,
+                compartment_linking_cols=linking_columns,
+                aggregation_operation=aggregate_steps["method"],
+                fields_of_view=aggregate_steps["fields"],
+                object_feature=object_feature,
+                add_image_features=add_image_features,
+                image_feature_categories=image_feature_categories,
+            )
+
+        if compartment_workers == 1 or len(self.compartments) == 1:
+            ap = create_single_cells()
+            ap.aggregate_profiles(
+                output_file=aggregate_output_file,
+                compression_options=self.pipeline_options["compression"],
+                float_format=self.pipeline_options["float_format"],
+            )
+            return
+
+        # Load and aggregate the compartments concurrently. Each thread has its
+        # own SingleCells object, and therefore its own SQLite connection. As in
+        # SingleCells.aggregate_profiles(), the object counts and image features
+        # are added with the first compartment.
+        def aggregate_compartment(compartment_idx):
+            ap = create_single_cells()
+            compartment = self.compartments[compartment_idx]
+            if compartment_idx > 0:
+                return ap.aggregate_compartment(compartment=compartment)
+            return ap.aggregate_compartment(
+                compartment=compartment,
+                compute_counts=True,
+                add_image_features=add_image_features,
+            )
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=compartment_workers
+        ) as executor:
+            compartment_dfs = list(
+                executor.map(aggregate_compartment, range(len(self.compartments)))
+            )
+
+        aggregated_df = compartment_dfs[0]
+        for compartment_df in compartment_dfs[1:]:
+            aggregated_df = aggregated_df.merge(compartment_df, on=strata, how="inner")
+
+        cyto_utils.output(
+            df=aggregated_df,
+            output_filename=aggregate_output_file,
             compression_options=self.pipeline_options["compression"],
             float_format=self.pipeline_options["float_format"],
         )
 
-    def pipeline_annotate(self, batch, plate):
-        annotate_steps = self.pipeline["annotate"]
-        output_dir = pathlib.PurePath(".", self.pipeline_output, batch, plate)
-        aggregate_output_file = pathlib.PurePath(output_dir, f"{plate}.csv.gz")
-        annotate_output_file = pathlib.PurePath(output_dir, f"{plate}_augmented.csv.gz")
-
+    def load_plate_map(self, batch, plate):
         metadata_dir = pathlib.PurePath(".", "metadata", "platemaps", batch)
         barcode_plate_map_file = pathlib.PurePath(metadata_dir, "barcode_platemap.csv")
         barcode_plate_map_df = pd.read_csv(
@@ -122,6 +192,43 @@ class RunPipeline(object):
             for x in plate_map_df.columns
         ]
 
+        return plate_map_df
+
+    def load_plate_inputs(self, batch, plate, stages):
+        # Load the inputs of the first per-plate stage that reads files which
+        # already exist, so that they can be prefetched while the previous
+        # plate is processed
+        output_dir = pathlib.PurePath(".", self.pipeline_output, batch, plate)
+        plate_inputs = {}
+
+        if "annotate" in stages:
+            plate_inputs["plate_map_df"] = self.load_plate_map(batch, plate)
+            if "aggregate" not in stages:
+                plate_inputs["aggregated_df"] = pd.read_csv(
+                    pathlib.PurePath(output_dir, f"{plate}.csv.gz")
+                )
+        elif "aggregate" not in stages and (
+            "normalize" in stages or "normalize_negcon" in stages
+        ):
+            plate_inputs["augmented_df"] = pd.read_csv(
+                pathlib.PurePath(output_dir, f"{plate}_augmented.csv.gz")
+            )
+
+        return plate_inputs
+
+    def pipeline_annotate(self, batch, plate, profiles=None, plate_map_df=None):
+        from pycytominer import annotate
+
+        annotate_steps = self.pipeline["annotate"]
+        output_dir = pathlib.PurePath(".", self.pipeline_output, batch, plate)
+        aggregate_output_file = pathlib.PurePath(output_dir, f"{plate}.csv.gz")
+        annotate_output_file = pathlib.PurePath(output_dir, f"{plate}_augmented.csv.gz")
+
+        if profiles is None:
+            profiles = aggregate_output_file
+        if plate_map_df is None:
+            plate_map_df = self.load_plate_map(batch, plate)
+
         platemap_well_column = self.pipeline["platemap_well_column"]
         annotate_well_column = annotate_steps["well_column"]
 
@@ -144,7 +251,7 @@ class RunPipeline(object):
                 ]
 
             annotate(
-                profiles=aggregate_output_file,
+                profiles=profiles,
                 platemap=plate_map_df,
                 join_on=[platemap_well_column, annotate_well_column],
                 external_metadata=external_df,
@@ -157,7 +264,7 @@ class RunPipeline(object):
             )
         else:
             annotate(
-                profiles=aggregate_output_file,
+                profiles=profiles,
                 platemap=plate_map_df,
                 join_on=[platemap_well_column, annotate_well_column],
                 output_file=annotate_output_file,
@@ -166,7 +273,11 @@ class RunPipeline(object):
                 clean_cellprofiler=True,
             )
 
-    def pipeline_normalize(self, batch, plate, steps, samples, suffix=None):
+    def pipeline_normalize(
+        self, batch, plate, steps, samples, suffix=None, profiles=None
+    ):
+        from pycytominer import normalize, cyto_utils
+
         normalize_steps = steps
         output_dir = pathlib.PurePath(".", self.pipeline_output, batch, plate)
         annotate_output_file = pathlib.PurePath(output_dir, f"{plate}_augmented.csv.gz")
@@ -183,13 +294,21 @@ class RunPipeline(object):
         fudge_factor = float(normalize_steps["mad_robustize_fudge_factor"])
         image_features = normalize_steps["image_features"]
 
+        if profiles is None:
+            profiles = annotate_output_file
+
         if normalization_features == "infer" and self.noncanonical:
-            normalization_features = cyto_utils.infer_cp_features(
-                pd.read_csv(annotate_output_file), compartments=self.compartments
-            )
+            if isinstance(profiles, pd.DataFrame):
+                normalization_features = cyto_utils.infer_cp_features(
+                    profiles, compartments=self.compartments
+                )
+            else:
+                normalization_features = cyto_utils.infer_cp_features(
+                    pd.read_csv(annotate_output_file), compartments=self.compartments
+                )
 
         normalize(
-            profiles=annotate_output_file,
+            profiles=profiles,
             features=normalization_features,
             image_features=image_features,
             samples=samples,
@@ -201,6 +320,9 @@ class RunPipeline(object):
         )
 
     def pipeline_feature_select(self, steps, suffix=None,min_cells=1):
+        from pycytominer import feature_select, cyto_utils
+        from pycytominer.cyto_utils import write_gct
+
         feature_select_steps = steps
         pipeline_output = self.pipeline["output_dir"]
 
@@ -210,35 +332,64 @@ class RunPipeline(object):
         feature_select_features = feature_select_steps["features"]
         image_features = feature_select_steps["image_features"]
 
+        if "workers" in feature_select_steps:
+            from feature_selection import select_features
+
+            feature_select_function = functools.partial(
+                select_features,
+                n_workers=feature_select_steps["workers"],
+                block_size=feature_select_steps.get("block_size", 500),
+            )
+        else:
+            feature_select_function = feature_select
+
         all_plates_df = pd.DataFrame()
 
+        def load_normalized(batch_plate):
+            batch, plate = batch_plate
+            output_dir = pathlib.PurePath(".", pipeline_output, batch, plate)
+            if suffix:
+                normalize_output_file = pathlib.PurePath(
+                    output_dir, f"{plate}_normalized_{suffix}.csv.gz"
+                )
+            else:
+                normalize_output_file = pathlib.PurePath(
+                    output_dir, f"{plate}_normalized.csv.gz"
+                )
+            return pd.read_csv(normalize_output_file)
+
+        # Read the next plate while the current one is processed
+        normalized_profiles = prefetch(
+            [
+                (batch, plate)
+                for batch in self.profile_config
+                for plate in self.profile_config[batch]
+            ],
+            load_normalized,
+        )
+
         for batch in self.profile_config:
             batch_df = pd.DataFrame()
             for plate in self.profile_config[batch]:
                 output_dir = pathlib.PurePath(".", pipeline_output, batch, plate)
                 if suffix:
-                    normalize_output_file = pathlib.PurePath(
-                        output_dir, f"{plate}_normalized_{suffix}.csv.gz"
-                    )
                     feature_select_output_file_plate = pathlib.PurePath(
                         output_dir,
                         f"{plate}_normalized_feature_select_{suffix}_plate.csv.gz",
                     )
                 else:
-                    normalize_output_file = pathlib.PurePath(
-                        output_dir, f"{plate}_normalized.csv.gz"
-                    )
                     feature_select_output_file_plate = pathlib.PurePath(
                         output_dir, f"{plate}_normalized_feature_select_plate.csv.gz"
                     )
+                _, normalized_df = next(normalized_profiles)
                 if feature_select_features == "infer" and self.noncanonical:
                     feature_select_features = cyto_utils.infer_cp_features(
-                        pd.read_csv(normalize_output_file),
+                        normalized_df,
                         compartments=self.compartments,
                     )
 
                 df = (
-                    pd.read_csv(normalize_output_file)
+                    normalized_df
                     .assign(Metadata_batch=batch)
                     .astype({'Metadata_Plate': str})
                 )
@@ -249,7 +400,7 @@ class RunPipeline(object):
                         fs_samples = "all"
                     else:
                         fs_samples = df.query(f"Metadata_Object_Count >= {min_cells}").index.values.tolist()
-                    feature_select(
+                    feature_select_function(
                         profiles=df,
                         features=feature_select_features,
                         image_features=image_features,
@@ -269,7 +420,7 @@ class RunPipeline(object):
                     fs_samples = "all"
                 else:
                     fs_samples = batch_df.query(f"Metadata_Object_Count >= {min_cells}").index.values.tolist()
-                fs_df = feature_select(
+                fs_df = feature_select_function(
                     profiles=batch_df,
                     features=feature_select_features,
                     image_features=image_features,
@@ -344,7 +495,7 @@ class RunPipeline(object):
                 fs_samples = "all"
             else:
                 fs_samples = all_plates_df.query(f"Metadata_Object_Count >= {min_cells}").index.values.tolist()
-            fs_df = feature_select(
+            fs_df = feature_select_function(
                 profiles=all_plates_df,
                 features=feature_select_features,
                 image_features=image_features,
@@ -420,6 +571,21 @@ class RunPipeline(object):
                     )
                     write_gct(profiles=fs_batch_df, output_file=gct_file)
 
+    def find_feature_select_file(self, batch, plate, suffix="negcon"):
+        # Prefer profiles feature selected across all plates, then batch, then plate
+        for level in ["all", "batch", "plate"]:
+            feature_select_file = pathlib.PurePath(
+                ".",
+                self.pipeline_output,
+                batch,
+                plate,
+                f"{plate}_normalized_feature_select_{suffix}_{level}.csv.gz",
+            )
+            if os.path.isfile(feature_select_file):
+                return feature_select_file
+
+        return None
+
     def pipeline_quality_control(self, operations):
         pipeline_output = self.pipeline["output_dir"]
 
@@ -491,20 +657,39 @@ class RunPipeline(object):
 
         if operations["heatmap"]["perform"]:
             print(f"Now generating heatmaps")
+            import plotly.express as px
+            from pycytominer import cyto_utils
+
             output_dir = pathlib.PurePath(".", "quality_control", "heatmap")
             if not os.path.isdir(pathlib.PurePath(output_dir)):
                 os.mkdir(output_dir)
+
+            def load_augmented(batch_plate):
+                batch, plate = batch_plate
+                input_file = pathlib.PurePath(
+                    ".",
+                    pipeline_output,
+                    batch,
+                    plate,
+                    f"{plate}_augmented.csv.gz",
+                )
+                return pd.read_csv(input_file)
+
+            # Read the next plate while the figures of the current one are made
+            augmented_profiles = prefetch(
+                [
+                    (batch, plate)
+                    for batch in self.profile_config
+                    for plate in self.profile_config[batch]
+                ],
+                load_augmented,
+            )
+
             for batch in self.profile_config:
                 for plate in self.profile_config[batch]:
-                    input_file = pathlib.PurePath(
-                        ".",
-                        pipeline_output,
-                        batch,
-                        plate,
-                        f"{plate}_augmented.csv.gz",
-                    )
+                    _, augmented_df = next(augmented_profiles)
                     df = (
-                        pd.read_csv(input_file)
+                        augmented_df
                         .assign(Metadata_Row=lambda x: x.Metadata_Well.str[0:1])
                         .assign(Metadata_Col=lambda x: x.Metadata_Well.str[1:])
                     )
@@ -538,55 +723,8 @@ class RunPipeline(object):
                     )
                     fig.write_image(output_file, width=640, height=480, scale=2)
 
-                    if os.path.isfile(
-                        pathlib.PurePath(
-                            ".",
-                            pipeline_output,
-                            batch,
-                            plate,
-                            f"{plate}_normalized_feature_select_negcon_all.csv.gz",
-                        )
-                    ):
-                        input_file = pathlib.PurePath(
-                            ".",
-                            pipeline_output,
-                            batch,
-                            plate,
-                            f"{plate}_normalized_feature_select_negcon_all.csv.gz",
-                        )
-                    elif os.path.isfile(
-                        pathlib.PurePath(
-                            ".",
-                            pipeline_output,
-                            batch,
-                            plate,
-                            f"{plate}_normalized_feature_select_negcon_batch.csv.gz",
-                        )
-                    ):
-                        input_file = pathlib.PurePath(
-                            ".",
-                            pipeline_output,
-                            batch,
-                            plate,
-                            f"{plate}_normalized_feature_select_negcon_batch.csv.gz",
-                        )
-                    elif os.path.isfile(
-                        pathlib.PurePath(
-                            ".",
-                            pipeline_output,
-                            batch,
-                            plate,
-                            f"{plate}_normalized_feature_select_negcon_plate.csv.gz",
-                        )
-                    ):
-                        input_file = pathlib.PurePath(
-                            ".",
-                            pipeline_output,
-                            batch,
-                            plate,
-                            f"{plate}_normalized_feature_select_negcon_plate.csv.gz",
-                        )
-                    else:
+                    input_file = self.find_feature_select_file(batch, plate)
+                    if input_file is None:
                         continue
 
                     df = pd.read_csv(input_file)
@@ -673,3 +811,120 @@ class RunPipeline(object):
                         f"{output_dir}/{batch}/{plate}/{plate}_position_effect.png"
                     )
                     fig.write_image(output_file, width=640, height=480, scale=2)
+
+        if (
+            "replicate_reproducibility" in operations
+            and operations["replicate_reproducibility"]["perform"]
+        ):
+            print(f"Now computing replicate reproducibility")
+            from pycytominer import cyto_utils
+
+            reproducibility_steps = operations["replicate_reproducibility"]
+            replicate_column = reproducibility_steps["replicate_column"]
+            exclude = reproducibility_steps.get("exclude", [])
+            exclude_control_types = reproducibility_steps.get(
+                "exclude_control_types", ["negcon"]
+            )
+            null_samples = reproducibility_steps.get("null_samples", 10000)
+            block_size = reproducibility_steps.get("block_size", 10000)
+            max_pairs = reproducibility_steps.get("max_pairs", 10000)
+
+            output_dir = pathlib.PurePath(
+                ".", "quality_control", "replicate_reproducibility"
+            )
+            if not os.path.isdir(pathlib.PurePath(output_dir)):
+                os.mkdir(output_dir)
+
+            def load_profiles(batch_plate):
+                input_file = self.find_feature_select_file(*batch_plate)
+                if input_file is None:
+                    return None
+                df = pd.read_csv(input_file)
+                df = df.loc[
+                    df[replicate_column].notna() & ~df[replicate_column].isin(exclude)
+                ]
+                if "Metadata_control_type" in df.columns:
+                    df = df.loc[
+                        ~df.Metadata_control_type.isin(exclude_control_types)
+                    ]
+                features = cyto_utils.infer_cp_features(df)
+                return df[[replicate_column] + features].astype(
+                    {x: np.float32 for x in features}
+                )
+
+            plate_dfs = [
+                df
+                for _, df in prefetch(
+                    [
+                        (batch, plate)
+                        for batch in self.profile_config
+                        for plate in self.profile_config[batch]
+                    ],
+                    load_profiles,
+                )
+                if df is not None
+            ]
+
+            if not plate_dfs:
+                print("No feature selected profiles found, skipping")
+                return
+
+            # Plates can be feature selected separately, so only the features
+            # common to all plates are used
+            features = [
+                x
+                for x in plate_dfs[0].columns
+                if x != replicate_column
+                and all(x in df.columns for df in plate_dfs[1:])
+            ]
+            treatments = np.concatenate(
+                [df[replicate_column].astype(str).values for df in plate_dfs]
+            )
+            profiles = np.concatenate([df[features].values for df in plate_dfs])
+            del plate_dfs
+
+            (
+                treatment_names,
+                replicate_counts,
+                replicate_correlation,
+                null_threshold,
+            ) = replicate_reproducibility(
+                profiles,
+                treatments,
+                null_samples=null_samples,
+                block_size=block_size,
+                max_pairs=max_pairs,
+            )
+
+            reproducibility_df = pd.DataFrame(
+                {
+                    replicate_column: treatment_names,
+                    "Replicate_Count": replicate_counts,
+                    "Replicate_Correlation": replicate_correlation,
+                    "Null_Threshold": null_threshold,
+                    "Above_Null_Threshold": replicate_correlation > null_threshold,
+                }
+            ).query("Replicate_Count > 1")
+            reproducibility_df.to_csv(
+                pathlib.PurePath(output_dir, "replicate_reproducibility.tsv"),
+                sep="\t",
+                index=False,
+                float_format="%.3f",
+            )
+
+            summary = pd.DataFrame(
+                {
+                    "Well_Count": [profiles.shape[0]],
+                    "Feature_Count": [profiles.shape[1]],
+                    "Treatment_Count": [reproducibility_df.shape[0]],
+                    "Percent_Replicating": [
+                        "%.3f"
+                        % (100 * reproducibility_df.Above_Null_Threshold.mean())
+                    ],
+                }
+            )
+            summary.to_csv(
+                pathlib.PurePath(output_dir, "replicate_reproducibility_summary.tsv"),
+                sep="\t",
+                index=False,
+            )
@@ -5,74 +5,419 @@ Perform the profiling pipeline (defined in profile.py).
 # Modified from
 # https://github.com/broadinstitute/profiling-resistance-mechanisms/blob/master/0.generate-profiles/generate-profiles.py
 
-from utils import load_pipeline, create_directories
+from utils import (
+    load_pipeline,
+    select_stages,
+    pipeline_stages,
+    create_directories,
+    parse_memory,
+    format_memory,
+    estimate_plate_memory,
+    next_admissible,
+    plan_schedule,
+    prefetch,
+    get_backend_file,
+)
 from profile import RunPipeline
 import argparse
+import concurrent.futures
+import os
+import sys
+import time
+import traceback
 
-parser = argparse.ArgumentParser(description="Run the profiling pipeline")
-parser.add_argument("--config", help="Config file")
+plate_stages = ["aggregate", "annotate", "normalize", "normalize_negcon"]
 
-args = parser.parse_args()
 
-pipeline, profile_config = load_pipeline(config_file=args.config)
+def get_plate_stages(pipeline):
+    return [
+        stage
+        for stage in plate_stages
+        if stage in pipeline and pipeline[stage]["perform"]
+    ]
 
-run_pipeline = RunPipeline(pipeline=pipeline, profile_config=profile_config)
 
-for batch in profile_config:
-    print(f"Now processing... batch: {batch}")
-    for plate in profile_config[batch]:
-        create_directories(batch=batch, plate=plate, pipeline=pipeline)
+def process_plate(
+    pipeline, profile_config, batch, plate, run_pipeline=None, plate_inputs=None
+):
+    if run_pipeline is None:
+        run_pipeline = RunPipeline(pipeline=pipeline, profile_config=profile_config)
+    if plate_inputs is None:
+        plate_inputs = {}
 
-        if "aggregate" in pipeline:
-            if pipeline["aggregate"]["perform"]:
-                print(f"Now aggregating... plate: {plate}")
-                run_pipeline.pipeline_aggregate(batch=batch, plate=plate)
+    create_directories(batch=batch, plate=plate, pipeline=pipeline)
 
-        if "annotate" in pipeline:
-            if pipeline["annotate"]["perform"]:
-                print(f"Now annotating... plate: {plate}")
-                run_pipeline.pipeline_annotate(batch=batch, plate=plate)
+    if "aggregate" in pipeline:
+        if pipeline["aggregate"]["perform"]:
+            print(f"Now aggregating... plate: {plate}")
+            run_pipeline.pipeline_aggregate(batch=batch, plate=plate)
 
-        if "normalize" in pipeline:
-            if pipeline["normalize"]["perform"]:
-                print(f"Now normalizing... plate: {plate}")
-                if pipeline["normalize"]["min_cells"] == 1:
-                    norm_samples = "all"
-                else:
-                    norm_samples = f'Metadata_Object_Count >= {pipeline["normalize"]["min_cells"]}'
-                run_pipeline.pipeline_normalize(
-                    batch=batch, plate=plate, steps=pipeline["normalize"], samples=norm_samples
+    if "annotate" in pipeline:
+        if pipeline["annotate"]["perform"]:
+            print(f"Now annotating... plate: {plate}")
+            run_pipeline.pipeline_annotate(
+                batch=batch,
+                plate=plate,
+                profiles=plate_inputs.get("aggregated_df"),
+                plate_map_df=plate_inputs.get("plate_map_df"),
+            )
+
+    if "normalize" in pipeline:
+        if pipeline["normalize"]["perform"]:
+            print(f"Now normalizing... plate: {plate}")
+            if pipeline["normalize"]["min_cells"] == 1:
+                norm_samples = "all"
+            else:
+                norm_samples = f'Metadata_Object_Count >= {pipeline["normalize"]["min_cells"]}'
+            run_pipeline.pipeline_normalize(
+                batch=batch,
+                plate=plate,
+                steps=pipeline["normalize"],
+                samples=norm_samples,
+                profiles=plate_inputs.get("augmented_df"),
+            )
+
+    if "normalize_negcon" in pipeline:
+        if pipeline["normalize_negcon"]["perform"]:
+            print(f"Now normalizing to negcon... plate: {plate}")
+            if pipeline["normalize_negcon"]["min_cells"] == 1:
+                norm_negcon_samples = "Metadata_control_type == 'negcon'"
+            else:
+                norm_negcon_samples = f"Metadata_control_type == 'negcon' & Metadata_Object_Count >= {pipeline['normalize_negcon']['min_cells']}"
+            run_pipeline.pipeline_normalize(
+                batch=batch,
+                plate=plate,
+                steps=pipeline["normalize_negcon"],
+                samples=norm_negcon_samples,
+                suffix="negcon",
+                profiles=plate_inputs.get("augmented_df"),
+            )
+
+
+def run_batch_stages(pipeline, run_pipeline):
+    if "feature_select" in pipeline:
+        if pipeline["feature_select"]["perform"]:
+            print(f"Now feature selecting... level: {pipeline['feature_select']['level']}")
+            run_pipeline.pipeline_feature_select(steps=pipeline["feature_select"], min_cells = pipeline["feature_select"]["min_cells"])
+
+    if "feature_select_negcon" in pipeline:
+        if pipeline["feature_select_negcon"]["perform"]:
+            print(
+                f"Now feature selecting negcon profiles... level: {pipeline['feature_select_negcon']['level']}"
+            )
+            run_pipeline.pipeline_feature_select(
+                steps=pipeline["feature_select_negcon"], suffix="negcon", min_cells = pipeline["feature_select_negcon"]["min_cells"]
+            )
+
+    if "quality_control" in pipeline:
+        if pipeline["quality_control"]["perform"]:
+            run_pipeline.pipeline_quality_control(operations=pipeline["quality_control"])
+
+
+def get_plate_input_files(pipeline, batch, plate, stages):
+    # The files that must be complete before a plate can be processed
+    output_dir = os.path.join(".", pipeline["output_dir"], batch, plate)
+    input_files = []
+
+    if "aggregate" in stages:
+        input_files.append(str(get_backend_file(batch, plate, "sqlite")))
+    elif "annotate" in stages:
+        input_files.append(os.path.join(output_dir, f"{plate}.csv.gz"))
+    elif "normalize" in stages or "normalize_negcon" in stages:
+        input_files.append(os.path.join(output_dir, f"{plate}_augmented.csv.gz"))
+
+    if (
+        "quality_control" in pipeline
+        and pipeline["quality_control"]["perform"]
+        and pipeline["quality_control"]["summary"]["perform"]
+    ):
+        input_files.append(
+            os.path.join(".", "load_data_csv", batch, plate, "load_data.csv.gz")
+        )
+
+    return input_files
+
+
+def get_plate_state(input_files):
+    # None while a file is missing or an SQLite transaction is still open,
+    # otherwise the sizes and modification times of the files
+    state = []
+    for input_file in input_files:
+        if not os.path.isfile(input_file):
+            return None
+        if any(
+            os.path.isfile(f"{input_file}{x}") for x in ["-journal", "-wal"]
+        ):
+            return None
+        file_stat = os.stat(input_file)
+        state.append((file_stat.st_size, file_stat.st_mtime))
+
+    return tuple(state)
+
+
+def watch(pipeline, profile_config, poll_interval, stable_seconds, debounce_seconds):
+    stages = get_plate_stages(pipeline)
+    run_pipeline = RunPipeline(pipeline=pipeline, profile_config=profile_config)
+
+    pending = [(batch, plate) for batch in profile_config for plate in profile_config[batch]]
+    processed_config = {}
+    plate_states = {}
+    stable_since = {}
+    last_processed = None
+    failed_plates = []
+    batch_stages_failed = False
+
+    print(f"Now watching... plates: {len(pending)}")
+    while pending or last_processed is not None:
+        for batch, plate in list(pending):
+            state = get_plate_state(
+                get_plate_input_files(pipeline, batch, plate, stages)
+            )
+            if state is None or state != plate_states.get((batch, plate)):
+                plate_states[(batch, plate)] = state
+                stable_since[(batch, plate)] = time.time()
+                continue
+            if time.time() - stable_since[(batch, plate)] < stable_seconds:
+                continue
+
+            pending.remove((batch, plate))
+            try:
+                process_plate(
+                    pipeline, profile_config, batch, plate, run_pipeline=run_pipeline
                 )
+            except Exception:
+                traceback.print_exc()
+                print(f"Failed to process... batch: {batch}, plate: {plate}")
+                failed_plates.append((batch, plate))
+                continue
+
+            processed_config.setdefault(batch, []).append(plate)
+            last_processed = time.time()
 
-        if "normalize_negcon" in pipeline:
-            if pipeline["normalize_negcon"]["perform"]:
-                print(f"Now normalizing to negcon... plate: {plate}")
-                if pipeline["normalize_negcon"]["min_cells"] == 1:
-                    norm_negcon_samples = "Metadata_control_type == 'negcon'"
-                else:
-                    norm_negcon_samples = f"Metadata_control_type == 'negcon' & Metadata_Object_Count >= {pipeline['normalize_negcon']['min_cells']}"
-                run_pipeline.pipeline_normalize(
-                    batch=batch,
-                    plate=plate,
-                    steps=pipeline["normalize_negcon"],
-                    samples=norm_negcon_samples,
-                    suffix="negcon",
+        # Rerun the batch level stages on the plates processed so far once no
+        # new plate has been processed for a while, or all plates are done
+        if last_processed is not None and (
+            not pending or time.time() - last_processed >= debounce_seconds
+        ):
+            print(
+                f"Now running batch level stages... plates: {sum(len(x) for x in processed_config.values())}"
+            )
+            batch_config = {
+                batch: list(plates) for batch, plates in processed_config.items()
+            }
+            try:
+                run_batch_stages(
+                    pipeline,
+                    RunPipeline(pipeline=pipeline, profile_config=batch_config),
                 )
+                batch_stages_failed = False
+            except Exception:
+                traceback.print_exc()
+                print("Failed to run batch level stages")
+                batch_stages_failed = True
+            last_processed = None
+
+        if pending:
+            time.sleep(poll_interval)
+
+    # Only the last run of the batch level stages counts, as it includes all
+    # the plates processed successfully
+    return failed_plates, batch_stages_failed
+
+
+def get_memory_estimates(pipeline, profile_config):
+    stages = get_plate_stages(pipeline)
+    return [
+        (batch, plate, estimate_plate_memory(pipeline, batch, plate, stages))
+        for batch in profile_config
+        for plate in profile_config[batch]
+    ]
 
-if "feature_select" in pipeline:
-    if pipeline["feature_select"]["perform"]:
-        print(f"Now feature selecting... level: {pipeline['feature_select']['level']}")
-        run_pipeline.pipeline_feature_select(steps=pipeline["feature_select"], min_cells = pipeline["feature_select"]["min_cells"])
 
-if "feature_select_negcon" in pipeline:
-    if pipeline["feature_select_negcon"]["perform"]:
+def print_plan(estimates, memory_budget, jobs):
+    schedule, peak = plan_schedule(estimates, memory_budget, jobs)
+    print(f"Memory budget: {format_memory(memory_budget)}, workers: {jobs}")
+    print("order\tbatch\tplate\testimated_memory\tstart\tmemory_in_use")
+    for idx, (batch, plate, memory, start, memory_in_use) in enumerate(schedule):
         print(
-            f"Now feature selecting negcon profiles... level: {pipeline['feature_select_negcon']['level']}"
+            f"{idx + 1}\t{batch}\t{plate}\t{format_memory(memory)}\t"
+            f"{start / 1e9:.1f}\t{format_memory(memory_in_use)}"
         )
-        run_pipeline.pipeline_feature_select(
-            steps=pipeline["feature_select_negcon"], suffix="negcon", min_cells = pipeline["feature_select_negcon"]["min_cells"]
+        if memory > memory_budget:
+            print(f"Warning: plate {plate} exceeds the memory budget and runs alone")
+    print(f"Estimated peak memory: {format_memory(peak)}")
+
+
+def run_plates(pipeline, profile_config, memory_budget, jobs):
+    pending = sorted(
+        get_memory_estimates(pipeline, profile_config),
+        key=lambda x: x[2],
+        reverse=True,
+    )
+    running = {}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            memory_in_use = sum(x[2] for x in running.values())
+            idx = None
+            if len(running) < jobs:
+                idx = next_admissible(
+                    pending, memory_in_use, memory_budget, len(running)
+                )
+            if idx is not None:
+                batch, plate, memory = pending.pop(idx)
+                print(
+                    f"Now processing... batch: {batch}, plate: {plate}, "
+                    f"estimated memory: {format_memory(memory)}, "
+                    f"in use: {format_memory(memory_in_use + memory)}"
+                )
+                future = executor.submit(
+                    process_plate, pipeline, profile_config, batch, plate
+                )
+                running[future] = (batch, plate, memory)
+                continue
+
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                running.pop(future)
+                future.result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the profiling pipeline")
+    parser.add_argument("--config", help="Config file")
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=pipeline_stages,
+        help="Run only these stages, overriding perform in the config file",
+    )
+    parser.add_argument(
+        "--batches",
+        nargs="+",
+        help="Process only these batches, overriding process in the config file",
+    )
+    parser.add_argument(
+        "--plates",
+        nargs="+",
+        help="Process only these plates, overriding process in the config file",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        help="Process plates in parallel while their estimated memory stays under this budget (e.g. 64G)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="Maximum number of plates processed in parallel (default: number of CPUs if --memory-budget is set, otherwise 1)",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Print the estimated schedule and peak memory without running the pipeline",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and process each plate as soon as its input files are complete",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=60,
+        help="Seconds between checks for new input files in watch mode (default: 60)",
+    )
+    parser.add_argument(
+        "--stable-seconds",
+        type=float,
+        default=300,
+        help="Seconds the input files of a plate must stay unchanged before it is processed in watch mode (default: 300)",
+    )
+    parser.add_argument(
+        "--debounce-seconds",
+        type=float,
+        default=600,
+        help="Seconds without a newly processed plate before the batch level stages are rerun in watch mode (default: 600)",
+    )
+
+    args = parser.parse_args()
+
+    if args.watch and (args.jobs is not None or args.memory_budget):
+        parser.error(
+            "--watch processes one plate at a time and cannot be combined with --jobs or --memory-budget"
+        )
+
+    try:
+        pipeline, profile_config = load_pipeline(
+            config_file=args.config, batches=args.batches, plates=args.plates
+        )
+    except ValueError as error:
+        parser.error(str(error))
+
+    if args.stages:
+        try:
+            pipeline = select_stages(pipeline, args.stages)
+        except ValueError as error:
+            parser.error(str(error))
+
+    memory_budget = float("inf")
+    if args.memory_budget:
+        try:
+            memory_budget = parse_memory(args.memory_budget)
+        except ValueError:
+            parser.error(
+                f"Invalid memory budget: {args.memory_budget}. Use a number with an optional K, M, G or T suffix (e.g. 64G)"
+            )
+
+    jobs = args.jobs
+    if jobs is None:
+        jobs = os.cpu_count() if args.memory_budget else 1
+
+    if args.plan:
+        print_plan(
+            get_memory_estimates(pipeline, profile_config), memory_budget, jobs
         )
+        sys.exit(0)
+
+    if args.watch:
+        failed_plates, batch_stages_failed = watch(
+            pipeline,
+            profile_config,
+            poll_interval=args.poll_interval,
+            stable_seconds=args.stable_seconds,
+            debounce_seconds=args.debounce_seconds,
+        )
+        for batch, plate in failed_plates:
+            print(f"Failed... batch: {batch}, plate: {plate}", file=sys.stderr)
+        if batch_stages_failed:
+            print("Failed... batch level stages", file=sys.stderr)
+        sys.exit(1 if failed_plates or batch_stages_failed else 0)
+
+    run_pipeline = RunPipeline(pipeline=pipeline, profile_config=profile_config)
+
+    if jobs > 1:
+        run_plates(pipeline, profile_config, memory_budget, jobs)
+    else:
+        # Load the existing inputs of the next plate in the background while
+        # the current plate is processed
+        stages = get_plate_stages(pipeline)
+        prefetched_inputs = prefetch(
+            [(batch, plate) for batch in profile_config for plate in profile_config[batch]],
+            lambda x: run_pipeline.load_plate_inputs(x[0], x[1], stages),
+        )
+        for batch in profile_config:
+            print(f"Now processing... batch: {batch}")
+            for plate in profile_config[batch]:
+                _, plate_inputs = next(prefetched_inputs)
+                process_plate(
+                    pipeline,
+                    profile_config,
+                    batch,
+                    plate,
+                    run_pipeline=run_pipeline,
+                    plate_inputs=plate_inputs,
+                )
 
-if "quality_control" in pipeline:
-    if pipeline["quality_control"]["perform"]:
-        run_pipeline.pipeline_quality_control(operations=pipeline["quality_control"])
+    run_batch_stages(pipeline, run_pipeline)
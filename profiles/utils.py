@@ -2,29 +2,131 @@
 # https://github.com/broadinstitute/profiling-resistance-mechanisms/blob/master/0.generate-profiles/scripts/profile_util.py
 
 import yaml
+import numpy as np
 import os
 import pathlib
-from pycytominer.cyto_utils import get_default_linking_cols, infer_cp_features
-import pandas as pd
+import queue
+import sqlite3
+import threading
 
 
-def load_pipeline(config_file):
+pipeline_stages = [
+    "aggregate",
+    "annotate",
+    "normalize",
+    "normalize_negcon",
+    "feature_select",
+    "feature_select_negcon",
+    "quality_control",
+]
+
+
+def load_pipeline(config_file, batches=None, plates=None):
+    # The batches and plates selectors, when given, replace the process flags
+    # in the config file
     profile_config = {}
+    found_batches = set()
+    found_plates = set()
     with open(config_file, "r") as stream:
         for data in yaml.load_all(stream, Loader=yaml.FullLoader):
             if "pipeline" in data.keys():
                 pipeline = data
             else:
-                process = data["process"]
+                batch = data["batch"]
+                found_batches.add(batch)
+                if batches is not None:
+                    process = batch in batches
+                elif plates is not None:
+                    process = True
+                else:
+                    process = data["process"]
                 if not process:
                     continue
-                batch = data["batch"]
-                plates = [str(x["name"]) for x in data["plates"] if x["process"]]
-                profile_config[batch] = plates
+                if plates is not None:
+                    plate_names = [
+                        str(x["name"]) for x in data["plates"] if str(x["name"]) in plates
+                    ]
+                    found_plates.update(plate_names)
+                else:
+                    plate_names = [str(x["name"]) for x in data["plates"] if x["process"]]
+                if plate_names or plates is None:
+                    profile_config[batch] = plate_names
+
+    if batches is not None:
+        missing_batches = [x for x in batches if x not in found_batches]
+        if missing_batches:
+            raise ValueError(
+                f"Batches not found in {config_file}: {', '.join(missing_batches)}"
+            )
+    if plates is not None:
+        missing_plates = [x for x in plates if x not in found_plates]
+        if missing_plates:
+            raise ValueError(
+                f"Plates not found in the selected batches of {config_file}: {', '.join(missing_plates)}"
+            )
 
     return pipeline, profile_config
 
 
+def select_stages(pipeline, stages):
+    for stage in stages:
+        if stage not in pipeline_stages:
+            raise ValueError(
+                f"Unknown stage: {stage}. Stages are: {', '.join(pipeline_stages)}"
+            )
+        if stage not in pipeline:
+            raise ValueError(f"Stage {stage} is not configured in the config file")
+
+    for stage in pipeline_stages:
+        if stage in pipeline:
+            pipeline[stage]["perform"] = stage in stages
+
+    return pipeline
+
+
+def prefetch(items, loader, depth=1):
+    # Yield (item, loader(item)) for each item while the next items are loaded
+    # on a background thread, so that reading and decompressing the next input
+    # overlaps with processing the current one. At most depth loaded items wait
+    # in the queue, which bounds the extra memory.
+    results = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    finished = object()
+
+    def put(result):
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def load_items():
+        for item in items:
+            try:
+                result = (item, loader(item), None)
+            except Exception as error:
+                result = (item, None, error)
+            if not put(result) or result[2] is not None:
+                return
+        put(finished)
+
+    thread = threading.Thread(target=load_items, daemon=True)
+    thread.start()
+    try:
+        while True:
+            result = results.get()
+            if result is finished:
+                break
+            item, loaded, error = result
+            if error is not None:
+                raise error
+            yield item, loaded
+    finally:
+        stop.set()
+
+
 def process_pipeline(pipeline, option):
     if option == "compression":
         if option in pipeline.keys():
@@ -66,6 +168,8 @@ def create_gct_directories(batch):
 
 
 def create_linking_columns(noncanonical, noncanonical_compartments):
+    from pycytominer.cyto_utils import get_default_linking_cols
+
     linking_columns = get_default_linking_cols()
 
     if noncanonical:
@@ -92,6 +196,9 @@ def get_pipeline_options(pipeline):
 
 
 def concat_dataframes(main_df, df, image_features):
+    import pandas as pd
+    from pycytominer.cyto_utils import infer_cp_features
+
     if main_df.shape[0] == 0:
         main_df = df.copy()
     else:
@@ -102,3 +209,417 @@ def concat_dataframes(main_df, df, image_features):
         main_df = main_df.reindex(columns=metadata_cols + feature_cols)
 
     return main_df
+
+
+# Peak memory model used to schedule plates. Aggregation loads one compartment
+# table at a time into pandas (8 bytes per value) and needs about twice that
+# while merging and grouping, which is where the README's "twice the size of
+# the .sqlite" rule comes from. The other per-plate stages work on well-level
+# profiles, whose in-memory size is roughly ten times the gzipped file size.
+# These factors are rules of thumb, not measurements: they are not calibrated
+# against the peak memory of real runs, so leave headroom in the budget.
+memory_model = {
+    "overhead": 1e9,
+    "aggregate_factor": 2.0,
+    "sqlite_factor": 2.0,
+    "profile_factor": 10.0,
+}
+
+memory_units = {"": 1, "K": 1e3, "M": 1e6, "G": 1e9, "T": 1e12}
+
+
+def parse_memory(memory):
+    text = str(memory).strip().upper()
+    if text.endswith("B"):
+        text = text[:-1]
+    unit = text[-1:] if text[-1:] in memory_units else ""
+    value = text[: len(text) - len(unit)].strip()
+    if not value:
+        raise ValueError(f"Invalid memory size: {memory!r}")
+
+    memory_bytes = float(value) * memory_units[unit]
+    if not np.isfinite(memory_bytes) or memory_bytes <= 0:
+        raise ValueError(f"Memory size must be a positive number: {memory!r}")
+
+    return memory_bytes
+
+
+def format_memory(memory):
+    if memory == float("inf"):
+        return "unlimited"
+    return f"{memory / 1e9:.1f}G"
+
+
+def get_backend_file(batch, plate, extension="sqlite"):
+    return pathlib.PurePath("../../backend", batch, plate, f"{plate}.{extension}")
+
+
+def get_sqlite_table_sizes(sqlite_file, tables):
+    table_sizes = {}
+    linking_features = {
+        column
+        for compartment_links in linking_columns.values()
+        for column in compartment_links.values()
+    }
+
+    uri = f"{pathlib.Path(os.path.abspath(sqlite_file)).as_uri()}?mode=ro"
+    try:
+        conn = sqlite3.connect(uri, uri=True)
+    except sqlite3.Error:
+        return table_sizes
+
+    try:
+        for table in tables:
+            # MAX(_rowid_) is read from the end of the b-tree, so it is cheap even
+            # for tables with millions of rows, unlike COUNT(*)
+            n_rows = conn.execute(f"SELECT MAX(_rowid_) FROM {table}").fetchone()[0]
+            n_columns = len(conn.execute(f"PRAGMA table_info({table})").fetchall())
+            table_sizes[table] = (n_rows or 0, n_columns)
+    except sqlite3.Error:
+        table_sizes = {}
+    finally:
+        conn.close()
+
+    return table_sizes
+
+
+def validate_backend_aggregate(
+    csv_file,
+    sqlite_file,
+    strata,
+    compartments,
+    image_feature_categories,
+    linking_columns,
+):
+    # Cheaply check that an aggregated .csv in the backend folder matches the
+    # .sqlite file: same strata columns and number of wells, object counts, and
+    # the same features as the .sqlite compartment tables, apart from the
+    # columns linking the compartments.
+    # Returns the reason the check failed, or None if it passed.
+    import pandas as pd
+
+    if not os.path.isfile(csv_file):
+        return f"{csv_file} not found"
+    if not os.path.isfile(sqlite_file):
+        return f"{sqlite_file} not found"
+
+    csv_columns = pd.read_csv(csv_file, nrows=0).columns.tolist()
+    missing_strata = [x for x in strata if x not in csv_columns]
+    if missing_strata:
+        return f"strata columns {missing_strata} missing from {csv_file}"
+    # Needed when normalizing or feature selecting with min_cells > 1
+    if "Metadata_Object_Count" not in csv_columns:
+        return f"Metadata_Object_Count missing from {csv_file}"
+
+    linking_features = {
+        column
+        for compartment_links in linking_columns.values()
+        for column in compartment_links.values()
+    }
+
+    uri = f"{pathlib.Path(os.path.abspath(sqlite_file)).as_uri()}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True)
+    try:
+        image_columns = [x[1] for x in conn.execute("PRAGMA table_info(Image)")]
+        missing_strata = [x for x in strata if x not in image_columns]
+        if missing_strata:
+            return f"strata columns {missing_strata} missing from the Image table"
+
+        strata_columns = ", ".join(strata)
+        sqlite_well_count = conn.execute(
+            f"SELECT COUNT(*) FROM (SELECT DISTINCT {strata_columns} FROM Image)"
+        ).fetchone()[0]
+
+        for compartment in compartments:
+            prefix = f"{compartment.capitalize()}_"
+            compartment_features = [x for x in csv_columns if x.startswith(prefix)]
+            if not compartment_features:
+                return f"no {compartment} features in {csv_file}"
+            table_columns = [
+                x[1] for x in conn.execute(f"PRAGMA table_info({compartment})")
+            ]
+            unknown_features = [
+                x for x in compartment_features if x not in table_columns
+            ]
+            if unknown_features:
+                return f"{len(unknown_features)} {compartment} features are not in the {compartment} table"
+            missing_features = [
+                x
+                for x in table_columns
+                if x.startswith(prefix)
+                and x not in linking_features
+                and x not in compartment_features
+            ]
+            if missing_features:
+                return f"{len(missing_features)} {compartment} features of the {compartment} table are missing from {csv_file}"
+    except sqlite3.Error as error:
+        return f"could not read {sqlite_file}: {error}"
+    finally:
+        conn.close()
+
+    for category in image_feature_categories:
+        if not any(x.startswith(f"Image_{category}_") for x in csv_columns):
+            return f"no Image_{category} features in {csv_file}"
+
+    csv_well_count = (
+        pd.read_csv(csv_file, usecols=strata).drop_duplicates().shape[0]
+    )
+    if csv_well_count != sqlite_well_count:
+        return f"{csv_well_count} wells in {csv_file} but {sqlite_well_count} in {sqlite_file}"
+
+    return None
+
+
+def estimate_plate_memory(pipeline, batch, plate, stages):
+    output_dir = pathlib.PurePath(".", pipeline["output_dir"], batch, plate)
+    stage_memory = [0]
+
+    if "aggregate" in stages:
+        sqlite_file = get_backend_file(batch, plate, "sqlite")
+        table_sizes = get_sqlite_table_sizes(sqlite_file, pipeline["compartments"])
+        if "compartment_workers" in pipeline["aggregate"]:
+            compartment_workers = pipeline["aggregate"]["compartment_workers"]
+        else:
+            compartment_workers = 1
+        if table_sizes:
+            # Compartments aggregated concurrently are in memory at the same time
+            largest_tables = sorted(
+                [n_rows * n_columns * 8 for n_rows, n_columns in table_sizes.values()],
+                reverse=True,
+            )[:compartment_workers]
+            stage_memory.append(
+                memory_model["aggregate_factor"] * sum(largest_tables)
+            )
+        elif os.path.isfile(sqlite_file):
+            stage_memory.append(
+                memory_model["sqlite_factor"] * os.path.getsize(sqlite_file)
+            )
+
+    profile_files = {
+        "annotate": pathlib.PurePath(output_dir, f"{plate}.csv.gz"),
+        "normalize": pathlib.PurePath(output_dir, f"{plate}_augmented.csv.gz"),
+        "normalize_negcon": pathlib.PurePath(output_dir, f"{plate}_augmented.csv.gz"),
+    }
+    for stage, profile_file in profile_files.items():
+        if stage in stages and os.path.isfile(profile_file):
+            stage_memory.append(
+                memory_model["profile_factor"] * os.path.getsize(profile_file)
+            )
+
+    return memory_model["overhead"] + max(stage_memory)
+
+
+def next_admissible(pending, memory_in_use, memory_budget, n_running):
+    # Largest plates are tried first, then any smaller plate that still fits.
+    # A plate that does not fit in the budget on its own runs alone.
+    for idx, (_, _, memory) in enumerate(pending):
+        if memory_in_use + memory <= memory_budget or n_running == 0:
+            return idx
+
+    return None
+
+
+def plan_schedule(estimates, memory_budget, jobs):
+    pending = sorted(estimates, key=lambda x: x[2], reverse=True)
+    running = []
+    schedule = []
+    clock = 0.0
+    peak = 0.0
+
+    # The estimated memory doubles as the estimated run time of a plate
+    while pending or running:
+        memory_in_use = sum(x[2] for x in running)
+        idx = None
+        if len(running) < jobs:
+            idx = next_admissible(pending, memory_in_use, memory_budget, len(running))
+        if idx is not None:
+            batch, plate, memory = pending.pop(idx)
+            running.append((batch, plate, memory, clock + memory))
+            schedule.append((batch, plate, memory, clock, memory_in_use + memory))
+            peak = max(peak, memory_in_use + memory)
+            continue
+
+        finished = min(running, key=lambda x: x[3])
+        running.remove(finished)
+        clock = finished[3]
+
+    return schedule, peak
+
+
+def standardize_rows(profiles):
+    # Center and scale each profile to unit length, so that the dot product of
+    # two profiles is their Pearson correlation
+    profiles = np.asarray(profiles, dtype=np.float32)
+    profiles = profiles - np.nanmean(profiles, axis=1, keepdims=True)
+    profiles = np.nan_to_num(profiles, copy=False)
+    norms = np.linalg.norm(profiles, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return profiles / norms
+
+
+def median_pairwise_correlation(
+    profiles, groups, block_size=10000, max_pairs=10000, random_state=None
+):
+    # groups is an (n_groups, group_size) array of row indices. The pairwise
+    # correlations within each group are computed with batched matrix products
+    # over blocks of about block_size rows, which bounds the memory use. Groups
+    # with more than max_pairs pairs use a random sample of max_pairs pairs.
+    n_groups, group_size = groups.shape
+    if group_size * (group_size - 1) // 2 > max_pairs:
+        return np.array(
+            [
+                sampled_median_correlation(
+                    profiles, group, max_pairs, block_size, random_state
+                )
+                for group in groups
+            ],
+            dtype=np.float32,
+        )
+
+    upper_rows, upper_cols = np.triu_indices(group_size, k=1)
+    groups_per_block = max(1, block_size // group_size)
+    medians = np.empty(n_groups, dtype=np.float32)
+
+    for start in range(0, n_groups, groups_per_block):
+        block = profiles[groups[start : start + groups_per_block]]
+        correlations = np.matmul(block, block.transpose(0, 2, 1))
+        medians[start : start + groups_per_block] = np.median(
+            correlations[:, upper_rows, upper_cols], axis=1
+        )
+
+    return medians
+
+
+def sampled_median_correlation(profiles, group, n_pairs, block_size, random_state):
+    # Median correlation of n_pairs random pairs of different wells of the group
+    first = random_state.randint(0, len(group), size=n_pairs)
+    second = random_state.randint(0, len(group) - 1, size=n_pairs)
+    second[second >= first] += 1
+
+    correlations = np.empty(n_pairs, dtype=np.float32)
+    for start in range(0, n_pairs, block_size):
+        end = start + block_size
+        correlations[start:end] = np.einsum(
+            "ij,ij->i",
+            profiles[group[first[start:end]]],
+            profiles[group[second[start:end]]],
+        )
+
+    return np.median(correlations)
+
+
+def sample_non_replicate_groups(codes, group_size, n_samples, random_state, n_tries=100):
+    # Sample groups of wells which all have different treatments. Groups with a
+    # repeated treatment are resampled, which rarely happens with many treatments.
+    # Groups that still repeat a treatment after n_tries (e.g. when there are
+    # barely more treatments than group_size) are dropped, so that no replicates
+    # end up in the null.
+    groups = random_state.randint(0, len(codes), size=(n_samples, group_size))
+    for _ in range(n_tries):
+        sorted_codes = np.sort(codes[groups], axis=1)
+        repeated = (np.diff(sorted_codes, axis=1) == 0).any(axis=1)
+        if not repeated.any():
+            break
+        groups[repeated] = random_state.randint(
+            0, len(codes), size=(repeated.sum(), group_size)
+        )
+
+    sorted_codes = np.sort(codes[groups], axis=1)
+    repeated = (np.diff(sorted_codes, axis=1) == 0).any(axis=1)
+
+    return groups[~repeated]
+
+
+def null_median_correlation(
+    profiles, codes, group_size, null_samples, block_size, max_pairs, random_state
+):
+    # The null groups are sampled and correlated in blocks of about block_size
+    # wells, so that all the sampled groups are never held in memory at once
+    samples_per_block = max(1, block_size // group_size)
+    null_correlation = []
+    for start in range(0, null_samples, samples_per_block):
+        null_groups = sample_non_replicate_groups(
+            codes,
+            group_size,
+            min(samples_per_block, null_samples - start),
+            random_state,
+        )
+        if null_groups.shape[0] > 0:
+            null_correlation.append(
+                median_pairwise_correlation(
+                    profiles,
+                    null_groups,
+                    block_size=block_size,
+                    max_pairs=max_pairs,
+                    random_state=random_state,
+                )
+            )
+
+    if not null_correlation:
+        return np.empty(0, dtype=np.float32)
+    return np.concatenate(null_correlation)
+
+
+def replicate_reproducibility(
+    profiles,
+    treatments,
+    null_samples=10000,
+    block_size=10000,
+    max_pairs=10000,
+    random_seed=0,
+):
+    profiles = standardize_rows(profiles)
+    treatment_names, codes = np.unique(np.asarray(treatments), return_inverse=True)
+    random_state = np.random.RandomState(random_seed)
+
+    replicate_counts = np.bincount(codes, minlength=len(treatment_names))
+    replicate_correlation = np.full(len(treatment_names), np.nan, dtype=np.float32)
+    null_threshold = np.full(len(treatment_names), np.nan, dtype=np.float32)
+
+    # Treatments with the same number of replicates are processed together and
+    # compared with a null of the same number of non-replicate wells
+    order = np.argsort(codes, kind="stable")
+    well_indices = np.split(order, np.cumsum(replicate_counts)[:-1])
+    for group_size in np.unique(replicate_counts[replicate_counts > 1]):
+        group_treatments = np.flatnonzero(replicate_counts == group_size)
+        if group_size * (group_size - 1) // 2 > max_pairs:
+            print(
+                f"Warning: the correlations of the {len(group_treatments)} treatments "
+                f"with {group_size} replicates are estimated from {max_pairs} random "
+                f"pairs of wells"
+            )
+        groups = np.stack([well_indices[x] for x in group_treatments])
+        replicate_correlation[group_treatments] = median_pairwise_correlation(
+            profiles,
+            groups,
+            block_size=block_size,
+            max_pairs=max_pairs,
+            random_state=random_state,
+        )
+
+        if group_size > len(treatment_names):
+            print(
+                f"Warning: no null for the treatments with {group_size} replicates, "
+                f"as there are only {len(treatment_names)} treatments"
+            )
+            continue
+        null_correlation = null_median_correlation(
+            profiles,
+            codes,
+            group_size,
+            null_samples,
+            block_size,
+            max_pairs,
+            random_state,
+        )
+        if null_correlation.shape[0] < null_samples:
+            print(
+                f"Warning: only {null_correlation.shape[0]} of {null_samples} null "
+                f"groups of {group_size} wells have no repeated treatment"
+            )
+        if null_correlation.shape[0] == 0:
+            continue
+        null_threshold[group_treatments] = np.nanpercentile(null_correlation, 95)
+
+    return treatment_names, replicate_counts, replicate_correlation, null_threshold
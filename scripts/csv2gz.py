@@ -1,13 +1,274 @@
 #!/usr/bin/env python
-import pycytominer.cyto_utils
+"""
+Compress (or convert) backend .csv profiles.
+
+Accepts files, directories (searched recursively for *.csv) and glob patterns.
+Files are streamed in chunks so memory stays bounded, converted in a process
+pool, and the output is read back to verify the row and column counts.
+"""
+
+import argparse
+import bz2
+import concurrent.futures
+import glob
+import gzip
+import lzma
+import os
 import sys
+import time
+
+import pandas as pd
+
+codec_extensions = {"gzip": ".gz", "bz2": ".bz2", "xz": ".xz", "zstd": ".zst"}
+
+
+def find_input_files(inputs, pattern="*.csv"):
+    input_files = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            input_files += sorted(
+                glob.glob(os.path.join(entry, "**", pattern), recursive=True)
+            )
+        elif os.path.isfile(entry):
+            input_files.append(entry)
+        else:
+            matches = sorted(glob.glob(entry, recursive=True))
+            if not matches:
+                print(f"No files found for {entry}", file=sys.stderr)
+            input_files += [x for x in matches if os.path.isfile(x)]
+
+    # Preserve the order given on the command line but drop repeats
+    return list(dict.fromkeys(input_files))
+
+
+def get_output_filename(input_filename, output_format, compression):
+    if output_format == "parquet":
+        return f"{os.path.splitext(input_filename)[0]}.parquet"
+    return input_filename + codec_extensions[compression]
+
+
+def open_compressed(filename, compression, mode="wt"):
+    if compression == "gzip":
+        return gzip.open(filename, mode, newline="")
+    if compression == "bz2":
+        return bz2.open(filename, mode, newline="")
+    if compression == "xz":
+        return lzma.open(filename, mode, newline="")
+    if compression == "zstd":
+        # Older pandas versions cannot (de)compress zstd themselves
+        import zstandard
+
+        return zstandard.open(filename, mode, newline="")
+    raise ValueError(f"Unsupported compression: {compression}")
+
+
+def write_csv(input_filename, output_filename, compression, float_format, chunksize):
+    n_rows = 0
+    n_columns = 0
+    with open_compressed(output_filename, compression) as handle:
+        for chunk_idx, chunk in enumerate(
+            pd.read_csv(input_filename, chunksize=chunksize)
+        ):
+            chunk.to_csv(
+                handle, index=False, header=chunk_idx == 0, float_format=float_format
+            )
+            n_rows += chunk.shape[0]
+            n_columns = chunk.shape[1]
+
+    return n_rows, n_columns
+
+
+def write_parquet(input_filename, output_filename, compression, chunksize):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    n_rows = 0
+    n_columns = 0
+    writer = None
+    schema = None
+    try:
+        for chunk in pd.read_csv(input_filename, chunksize=chunksize):
+            if schema is None:
+                # Integer columns are stored as float so that a later chunk with
+                # missing values still matches the schema of the first chunk
+                schema = pa.Schema.from_pandas(
+                    chunk.astype(
+                        {
+                            x: "float64"
+                            for x in chunk.select_dtypes(include="integer").columns
+                        }
+                    ),
+                    preserve_index=False,
+                )
+                writer = pq.ParquetWriter(
+                    output_filename, schema, compression=compression
+                )
+            writer.write_table(
+                pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            )
+            n_rows += chunk.shape[0]
+            n_columns = chunk.shape[1]
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return n_rows, n_columns
+
+
+def count_output(output_filename, output_format, compression, chunksize):
+    if output_format == "parquet":
+        import pyarrow.parquet as pq
+
+        metadata = pq.ParquetFile(output_filename).metadata
+        return metadata.num_rows, metadata.num_columns
+
+    n_rows = 0
+    n_columns = 0
+    with open_compressed(output_filename, compression, mode="rt") as handle:
+        for chunk in pd.read_csv(handle, chunksize=chunksize):
+            n_rows += chunk.shape[0]
+            n_columns = chunk.shape[1]
+
+    return n_rows, n_columns
+
+
+def convert_file(
+    input_filename, output_format, compression, float_format, chunksize, verify
+):
+    output_filename = get_output_filename(input_filename, output_format, compression)
+
+    start = time.perf_counter()
+    if output_format == "parquet":
+        n_rows, n_columns = write_parquet(
+            input_filename, output_filename, compression, chunksize
+        )
+    else:
+        n_rows, n_columns = write_csv(
+            input_filename, output_filename, compression, float_format, chunksize
+        )
+
+    verified = None
+    if verify:
+        verified = count_output(
+            output_filename, output_format, compression, chunksize
+        ) == (n_rows, n_columns)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "input_file": input_filename,
+        "output_file": output_filename,
+        "rows": n_rows,
+        "columns": n_columns,
+        "input_mb": os.path.getsize(input_filename) / 1e6,
+        "output_mb": os.path.getsize(output_filename) / 1e6,
+        "seconds": elapsed,
+        "verified": verified,
+    }
+
+
+def print_summary(results, failures, elapsed):
+    for result in results:
+        throughput = result["input_mb"] / max(result["seconds"], 1e-9)
+        verified = {True: "ok", False: "MISMATCH", None: "skipped"}[result["verified"]]
+        print(
+            f"{result['output_file']}: {result['rows']} rows x {result['columns']} columns, "
+            f"{result['input_mb']:.1f} MB -> {result['output_mb']:.1f} MB "
+            f"in {result['seconds']:.1f} s ({throughput:.1f} MB/s), verify: {verified}"
+        )
+
+    total_mb = sum(x["input_mb"] for x in results)
+    print(
+        f"Converted {len(results)} files ({total_mb:.1f} MB) in {elapsed:.1f} s "
+        f"({total_mb / max(elapsed, 1e-9):.1f} MB/s), {len(failures)} failed"
+    )
+    for input_filename, error in failures:
+        print(f"Failed: {input_filename}: {error}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compress .csv profiles")
+    parser.add_argument(
+        "inputs", nargs="+", help="Files, directories or glob patterns to convert"
+    )
+    parser.add_argument(
+        "--pattern",
+        default="*.csv",
+        help="Pattern used to find files in directories (default: *.csv)",
+    )
+    parser.add_argument(
+        "--format",
+        dest="output_format",
+        choices=["csv", "parquet"],
+        default="csv",
+        help="Output format (default: csv)",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=sorted(codec_extensions),
+        default=None,
+        help="Compression codec (default: gzip for csv, zstd for parquet)",
+    )
+    parser.add_argument(
+        "--float-format",
+        default="%.5g",
+        help="Float format of csv output (default: %%.5g)",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=10000,
+        help="Number of rows read and written at a time (default: 10000)",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="Number of files converted in parallel"
+    )
+    parser.add_argument(
+        "--no-verify",
+        dest="verify",
+        action="store_false",
+        help="Skip reading the output back to check the row and column counts",
+    )
+    args = parser.parse_args()
+
+    compression = args.compression
+    if compression is None:
+        compression = "zstd" if args.output_format == "parquet" else "gzip"
+    if args.output_format == "parquet" and compression not in ["gzip", "zstd"]:
+        parser.error(f"{compression} compression is not supported for parquet output")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.chunksize < 1:
+        parser.error("--chunksize must be at least 1")
 
-input_filename = sys.argv[1]
+    input_files = find_input_files(args.inputs, pattern=args.pattern)
+    if not input_files:
+        print("No input files found", file=sys.stderr)
+        sys.exit(1)
 
-output_filename = input_filename + ".gz"
+    results = []
+    failures = []
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {
+            executor.submit(
+                convert_file,
+                input_filename,
+                args.output_format,
+                compression,
+                args.float_format,
+                args.chunksize,
+                args.verify,
+            ): input_filename
+            for input_filename in input_files
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as error:
+                failures.append((futures[future], error))
 
-df = pycytominer.cyto_utils.load.load_profiles(input_filename)
+    results = sorted(results, key=lambda x: x["input_file"])
+    print_summary(results, failures, time.perf_counter() - start)
 
-df = pycytominer.cyto_utils.output(
-    df, output_filename, compression_options="gzip", float_format="%.5g"
-)
+    if failures or any(x["verified"] is False for x in results):
+        sys.exit(1)